@@ -1,13 +1,20 @@
 import pandas as pd
 import yfinance as yf
-from datetime import datetime
-import time
-import json
+from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson
 import os
 import sys
-from google import genai
 from dotenv import load_dotenv
 
+import stock_common
+# 銘柄リストの読み込み・取得処理・列定義は両モジュール共通 (stock_common.py)
+from stock_common import (
+    YFRateLimitError, read_codes, MONEY_COLS, MONEY_RENAME_MAP, RESULT_COLUMNS,
+    results_to_dataframe
+)
+
 # 文字エンコードの問題を回避するための設定
 load_dotenv()
 
@@ -17,11 +24,15 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 client = None
 if GEMINI_API_KEY:
     try:
+        # google-genai は読み込みが重いため、APIキーがある場合のみ import する
+        from google import genai
         client = genai.Client(api_key=GEMINI_API_KEY)
     except Exception as e:
         print(f"⚠️ Gemini Client Init Error: {e}")
 
 # --- 1. AIによるセグメント分析 (エンコードエラー対策を最大化) ---
+AI_CONCURRENCY = 5 # Geminiへの同時リクエスト数 (1分あたりの回数は stock_common 側で制限)
+
 def batch_analyze_segments(all_results_list):
     if not client:
         return all_results_list
@@ -34,71 +45,85 @@ def batch_analyze_segments(all_results_list):
     
     batch_size = 15 # 負荷を減らすため少し小さく
     model_name = 'gemini-2.0-flash'
+
+    # バッチごとに待たず、スレッドで並行してリクエストする
+    _analyze_batches(targets, batch_size, model_name)
+
+    return all_results_list
+
+def _analyze_batches(targets, batch_size, model_name):
+    # 同期クライアントはイベントループに依存しないので、何度実行しても使い回せる
+    with ThreadPoolExecutor(max_workers=AI_CONCURRENCY) as executor:
+        list(executor.map(
+            lambda i: _analyze_batch(targets[i : i + batch_size], i, model_name),
+            range(0, len(targets), batch_size)
+        ))
+
+def _analyze_batch(batch, i, model_name):
+    parts = []
+    for item in batch:
+        # ★エンコード対策：特殊文字を除去し、ASCIIで表現可能な形式に一旦落としてから戻す、または確実にUTF-8で扱う
+        summary = str(item.get('Summary of Business', ''))[:500]
+        # 改行やタブを排除して1行にする
+        summary = " ".join(summary.split())
+        parts.append(f"Code: {item['Code']}\nSummary: {summary}\n---\n")
+    # 文字列の += を繰り返さず、最後に一度だけ連結する
+    input_text = "".join(parts)
+
+    prompt = f"""
+    Extract the main 'Business Segments' for EACH company based on the summary.
+    Return ONLY a JSON object: {{"CODE": "Segments", ...}}
     
-    for i in range(0, len(targets), batch_size):
-        batch = targets[i : i + batch_size]
+    # Input Data
+    {input_text}
+    """
+
+    try:
+        # AIへのリクエスト (1分あたりの上限を守り、429 の時は待って再試行する)
+        response = stock_common.generate_content(client, model_name, prompt)
         
-        input_text = ""
-        for item in batch:
-            # ★エンコード対策：特殊文字を除去し、ASCIIで表現可能な形式に一旦落としてから戻す、または確実にUTF-8で扱う
-            summary = str(item.get('Summary of Business', ''))[:500]
-            # 改行やタブを排除して1行にする
-            summary = " ".join(summary.split())
-            input_text += f"Code: {item['Code']}\nSummary: {summary}\n---\n"
-
-        prompt = f"""
-        Extract the main 'Business Segments' for EACH company based on the summary.
-        Return ONLY a JSON object: {{"CODE": "Segments", ...}}
+        response_text = response.text.strip()
+        
+        # JSONの抽出
+        if "```json" in response_text:
+            response_text = response_text.split("```json")[1].split("```")[0].strip()
+        elif "```" in response_text:
+            response_text = response_text.split("```")[1].split("```")[0].strip()
         
-        # Input Data
-        {input_text}
-        """
+        # 先頭や末尾にゴミがあれば除去
+        start_idx = response_text.find('{')
+        end_idx = response_text.rfind('}') + 1
+        if start_idx != -1 and end_idx != 0:
+            response_text = response_text[start_idx:end_idx]
 
-        try:
-            # AIへのリクエスト
-            response = client.models.generate_content(
-                model=model_name,
-                contents=prompt
-            )
-            
-            response_text = response.text.strip()
-            
-            # JSONの抽出
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0].strip()
-            
-            # 先頭や末尾にゴミがあれば除去
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            if start_idx != -1 and end_idx != 0:
-                response_text = response_text[start_idx:end_idx]
-
-            segments_map = json.loads(response_text)
-
-            for item in batch:
-                code = item['Code']
-                if code in segments_map:
-                    item['Segments'] = str(segments_map[code])
-            
-            time.sleep(1.5)
-
-        except Exception as e:
-            # エラーメッセージ自体のエンコードエラーも防ぐ
-            print(f"⚠️ Batch AI Error for chunk {i}: AI Analysis Skipped")
-            continue
+        segments_map = orjson.loads(response_text)
 
-    return all_results_list
+        for item in batch:
+            code = item['Code']
+            if code in segments_map:
+                item['Segments'] = str(segments_map[code])
+
+    except orjson.JSONDecodeError:
+        print(f"⚠️ Batch AI Error for chunk {i}: Invalid JSON response, AI Analysis Skipped")
+    except Exception as e:
+        # エラーメッセージ自体のエンコードエラーも防ぐ
+        print(f"⚠️ Batch AI Error for chunk {i}: AI Analysis Skipped")
 
 # --- 2. データ取得関数 (404対策と安定化) ---
+# app.py と data_processor.py は同じ銘柄でも保存する形が異なるため、ディレクトリを分ける
+CACHE_DIR = os.path.join(stock_common.CACHE_ROOT, "app")
+
 def get_stock_data(code):
+    # 同日中に取得済みの銘柄はディスクキャッシュから返す
+    return stock_common.get_stock_data(code, _request_stock_data, CACHE_DIR)
+
+def _request_stock_data(code):
     try:
         # yfinanceのセッションを安定させるための工夫
         ticker = yf.Ticker(code)
         
-        # まずは基本的なinfoが取れるか確認
-        info = ticker.info
+        # まずは基本的なinfoが取れるか確認 (以降は Ticker に触れずこの dict だけを参照する)
+        info = dict(ticker.info or {})
         
         # クラウド環境では info が空になる場合があるため、historyで補完を試みる
         if not info or len(info) < 5:
@@ -107,7 +132,6 @@ def get_stock_data(code):
                 print(f"Skipped {code}: No data available on Yahoo Finance")
                 return None
             # 最小限の情報を偽装してエラーを防ぐ
-            info = info if info else {}
             info['symbol'] = code
             info['shortName'] = info.get('shortName', code)
 
@@ -115,30 +139,61 @@ def get_stock_data(code):
             "info": info,
             "balance_sheet": ticker.balance_sheet,
             "financials": ticker.financials,
-            "major_holders": ticker.major_holders,
-            "institutional_holders": ticker.institutional_holders
+            "major_holders": ticker.major_holders
         }
+    except YFRateLimitError:
+        raise
     except Exception as e:
         print(f"Skipped {code}: {str(e)[:50]}")
         return None
 
+def get_all_stock_data(codes, max_workers=8, progress_callback=None):
+    # 戻り値は {コード: raw_data (取得失敗時は None)}。progress_callback(完了数, 総数) は間引いて呼ぶ
+    return stock_common.get_all_stock_data(codes, get_stock_data, max_workers, progress_callback)
+
 def get_exchange_rate(from_currency):
     if not from_currency or from_currency == "SGD":
         return 1.0
     
     currency_code = "CNY" if from_currency == "RMB (CNY)" else from_currency
-    pair = f"{currency_code}SGD=X"
     
     try:
-        ticker = yf.Ticker(pair)
-        # infoから取れない場合はhistoryを使う
-        hist = ticker.history(period="5d")
-        if not hist.empty:
-            return hist['Close'].iloc[-1]
-        return ticker.info.get('previousClose', "N/A")
-    except:
+        # 同じ通貨は1日1回だけ取得する (通信エラーやデータなしはキャッシュされない)
+        return _fetch_exchange_rate(currency_code, date.today())
+    except Exception:
         return "N/A"
 
+@lru_cache(maxsize=32)
+def _fetch_exchange_rate(currency_code, cache_day):
+    ticker = yf.Ticker(f"{currency_code}SGD=X")
+    # infoから取れない場合はhistoryを使う
+    hist = ticker.history(period="5d")
+    if not hist.empty:
+        return hist['Close'].iloc[-1]
+    rate = ticker.info.get('previousClose')
+    if rate is None:
+        # "N/A" を返すとその日はキャッシュされてしまうため、例外にして再取得させる
+        raise ValueError(f"No exchange rate for {currency_code}")
+    return rate
+
+def prefetch_exchange_rates(raw_data_list):
+    # 登場する通貨を先に集め、全ペアを1回の yf.download でまとめて取得する
+    currencies = {get_display_currency(raw["info"]) for raw in raw_data_list if raw}
+    rates = {c: 1.0 for c in currencies if not c or c == "SGD"}
+    pairs = {f"{'CNY' if c == 'RMB (CNY)' else c}SGD=X": c for c in currencies if c not in rates}
+    if pairs:
+        try:
+            closes = yf.download(list(pairs), period="5d", progress=False)["Close"].ffill()
+            for pair, currency in pairs.items():
+                if pair in closes.columns and pd.notnull(closes[pair].iloc[-1]):
+                    rates[currency] = closes[pair].iloc[-1]
+        except Exception:
+            pass
+    # 一括取得できなかった通貨だけ個別に取得する
+    for currency in currencies - rates.keys():
+        rates[currency] = get_exchange_rate(currency)
+    return rates
+
 # --- 3. データの抽出・整形 ---
 def format_shareholders(holders_data):
     if holders_data is None or holders_data.empty:
@@ -152,10 +207,30 @@ def format_shareholders(holders_data):
             value = str(row.iloc[0])
             lines.append(f"{name}: {value}")
         return "\n".join(lines)
-    except:
+    except (IndexError, KeyError, TypeError, ValueError):
         return "Data Parsing Error"
 
-def extract_data(code, raw_data):
+INCOME_KEYS = [
+    "Total Revenue", "Pretax Income", "Operating Income", "Gross Profit",
+    "Net Income", "Net Income Including Noncontrolling Interests"
+]
+BALANCE_KEYS = [
+    "Total Assets", "Total Equity Gross Minority Interest", "Stockholders Equity",
+    "Total Debt", "Minority Interest"
+]
+
+def latest_values(df, latest_date, keys):
+    if df is None or df.empty or latest_date not in df.columns:
+        return dict.fromkeys(keys, 0)
+    col = df[latest_date]
+    col = col[~col.index.duplicated()]
+    return col.reindex(keys).fillna(0).to_dict()
+
+def get_display_currency(info):
+    raw_currency = info.get('financialCurrency', info.get('currency', 'SGD'))
+    return 'RMB (CNY)' if raw_currency == 'CNY' else raw_currency
+
+def extract_data(code, raw_data, exchange_rates=None):
     info = raw_data.get("info", {})
     bs = raw_data.get("balance_sheet")
     inc = raw_data.get("financials")
@@ -165,40 +240,41 @@ def extract_data(code, raw_data):
     if bs is not None and not bs.empty: latest_date = bs.columns[0]
     elif inc is not None and not inc.empty: latest_date = inc.columns[0]
 
-    def get_val(df, key):
-        if df is not None and not df.empty and key in df.index and latest_date in df.columns:
-            val = df.loc[key, latest_date]
-            return val if pd.notnull(val) else 0
-        return 0
+    # 必要な科目を最新期のカラムからまとめて取り出す (1科目ずつ .loc で引かない)
+    inc_vals = latest_values(inc, latest_date, INCOME_KEYS)
+    bs_vals = latest_values(bs, latest_date, BALANCE_KEYS)
 
-    revenue = get_val(inc, "Total Revenue")
-    op_income = get_val(inc, "Operating Income")
-    net_profit = get_val(inc, "Net Income")
+    revenue = inc_vals["Total Revenue"]
+    op_income = inc_vals["Operating Income"]
+    net_profit = inc_vals["Net Income"]
     
-    total_assets = get_val(bs, "Total Assets")
-    total_equity = get_val(bs, "Total Equity Gross Minority Interest") or get_val(bs, "Stockholders Equity")
-    loan = get_val(bs, "Total Debt")
+    total_assets = bs_vals["Total Assets"]
+    total_equity = bs_vals["Total Equity Gross Minority Interest"] or bs_vals["Stockholders Equity"]
+    loan = bs_vals["Total Debt"]
 
-    raw_currency = info.get('financialCurrency', info.get('currency', 'SGD'))
-    display_currency = 'RMB (CNY)' if raw_currency == 'CNY' else raw_currency
+    display_currency = get_display_currency(info)
+    if exchange_rates and display_currency in exchange_rates:
+        exchange_rate = exchange_rates[display_currency]
+    else:
+        exchange_rate = get_exchange_rate(display_currency)
 
     return {
         "Name of Company": info.get('longName') or info.get('shortName') or code,
         "Code": code,
         "Currency": display_currency,
-        "Exchange Rate": get_exchange_rate(display_currency),
+        "Exchange Rate": exchange_rate,
         "Website": info.get('website', ''),
         "Major Shareholders": format_shareholders(raw_data.get("major_holders")),
         "FY": datetime.fromtimestamp(info['lastFiscalYearEnd']) if info.get('lastFiscalYearEnd') else None,
         "REVENUE": revenue,
         "Segments": "",
-        "PROFIT": get_val(inc, "Pretax Income") or op_income,
-        "GROSS PROFIT": get_val(inc, "Gross Profit"),
+        "PROFIT": inc_vals["Pretax Income"] or op_income,
+        "GROSS PROFIT": inc_vals["Gross Profit"],
         "OPERATING PROFIT": op_income,
-        "NET PROFIT (Group)": get_val(inc, "Net Income Including Noncontrolling Interests") or net_profit,
+        "NET PROFIT (Group)": inc_vals["Net Income Including Noncontrolling Interests"] or net_profit,
         "NET PROFIT (Shareholders)": net_profit,
-        "Minority Interest": get_val(bs, "Minority Interest"),
-        "Shareholders' Equity": get_val(bs, "Stockholders Equity"),
+        "Minority Interest": bs_vals["Minority Interest"],
+        "Shareholders' Equity": bs_vals["Stockholders Equity"],
         "Total Equity": total_equity,
         "TOTAL ASSET": total_assets,
         "Debt/Equity(%)": (total_assets - total_equity) / total_equity if total_equity else 0,
@@ -218,20 +294,16 @@ def extract_data(code, raw_data):
     }
 
 def format_for_excel(df):
-    money_cols = [
-        'REVENUE', 'PROFIT', 'GROSS PROFIT', 'OPERATING PROFIT', 
-        'NET PROFIT (Group)', 'NET PROFIT (Shareholders)', 'Minority Interest',
-        "Shareholders' Equity", 'Total Equity', 'TOTAL ASSET', 'Loan',
-        'Market Cap', 'Shares Outstanding'
-    ]
-    for col in money_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0) / 1000.0
-
-    df = df.rename(columns={c: f"{c} ('000)" for c in money_cols})
-    if "REVENUE ('000)" in df.columns:
-        df = df.rename(columns={"REVENUE ('000)": "REVENUE SGD('000)"})
+    # 金額列はまとめて数値化し、一括で千単位に変換する
+    money_cols = [c for c in MONEY_COLS if c in df.columns]
+    if money_cols:
+        df[money_cols] = df[money_cols].apply(pd.to_numeric, errors='coerce').fillna(0) / 1000.0
+
+    df = df.rename(columns=MONEY_RENAME_MAP)
 
     if 'FY' in df.columns:
-        df['FY'] = pd.to_datetime(df['FY'], errors='coerce').dt.strftime('%b %Y').fillna('')
+        # extract_data で既に datetime になっている場合は再パースしない
+        if not pd.api.types.is_datetime64_any_dtype(df['FY']):
+            df['FY'] = pd.to_datetime(df['FY'], errors='coerce')
+        df['FY'] = df['FY'].dt.strftime('%b %Y').fillna('')
     return df
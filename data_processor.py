@@ -1,20 +1,33 @@
 import pandas as pd
 import yfinance as yf
-from datetime import datetime
-import time
-import json
+from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson
 import os
-from google import genai
 from dotenv import load_dotenv
 
+import stock_common
+# 銘柄リストの読み込み・取得処理・列定義は両モジュール共通 (stock_common.py)
+from stock_common import (
+    YFRateLimitError, read_codes, MONEY_COLS, MONEY_RENAME_MAP, RESULT_COLUMNS,
+    results_to_dataframe
+)
+
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 client = None
 if GEMINI_API_KEY:
+    # google-genai は読み込みが重いため、APIキーがある場合のみ import する
+    from google import genai
     client = genai.Client(api_key=GEMINI_API_KEY)
 
 # --- 1. AIによるセグメント分析 ---
+# Gemini への同時リクエスト数。1分あたりの回数は stock_common.generate_content で制限する
+AI_CONCURRENCY = 5
+
+
 def batch_analyze_segments(all_results_list):
     if not client:
         print("  ⚠️ APIキー(.env)が見つからないため、AI分析をスキップします")
@@ -29,71 +42,98 @@ def batch_analyze_segments(all_results_list):
     
     batch_size = 20
     model_name = 'gemini-2.5-flash'
-    
-    for i in range(0, len(targets), batch_size):
-        batch = targets[i : i + batch_size]
-        current_count = min(i + batch_size, len(targets))
-        print(f"  - バッチ処理中: {i+1}〜{current_count} 件目...")
 
-        input_text = ""
-        for item in batch:
-            summary_snippet = str(item['Summary of Business'])[:500].replace("\n", " ")
-            input_text += f"Code: {item['Code']}\nSummary: {summary_snippet}...\n---\n"
+    # ★変更: バッチを順番に待たず、スレッドで並行してリクエストする
+    _analyze_batches(targets, batch_size, model_name)
 
-        prompt = f"""
-        You are a financial analyst. I will provide business summaries for multiple companies.
-        Extract the main 'Business Segments' for EACH company based on the summary.
+    print("✅ AI分析完了\n")
+    return all_results_list
 
-        # Input Data
-        {input_text}
-        
-        # Output Rules
-        - Return ONLY a valid JSON object.
-        - The keys must be the stock 'Code'.
-        - The values must be the 'Business Segments' (comma separated string, clear and concise).
-        - If segments are not clearly stated, summarize the main business areas in 3-4 words.
-        - Example JSON Format:
-        {{
-            "4863.KL": "Telecommunication Services, Digital Solutions",
-            "0021.KL": "Payment Services, Solution Services"
-        }}
-        """
 
-        try:
-            response = client.models.generate_content(
-                model=model_name,
-                contents=prompt
-            )
-            response_text = response.text.strip()
-            
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0].strip()
-            
-            segments_map = json.loads(response_text)
+def _analyze_batches(targets, batch_size, model_name):
+    # 同期クライアントはスレッド間で共有でき、イベントループにも依存しないため
+    # 同じプロセスで何度分析を実行しても安全に使い回せる
+    with ThreadPoolExecutor(max_workers=AI_CONCURRENCY) as executor:
+        list(executor.map(
+            lambda i: _analyze_batch(targets, i, batch_size, model_name),
+            range(0, len(targets), batch_size)
+        ))
 
-            for item in batch:
-                code = item['Code']
-                if code in segments_map:
-                    item['Segments'] = segments_map[code]
-            
-            time.sleep(1)
 
-        except Exception as e:
-            print(f"  ⚠️ バッチ処理エラー (このバッチはスキップします): {e}")
+def _analyze_batch(targets, i, batch_size, model_name):
+    batch = targets[i : i + batch_size]
+    current_count = min(i + batch_size, len(targets))
 
-    print("✅ AI分析完了\n")
-    return all_results_list
+    parts = []
+    for item in batch:
+        summary_snippet = str(item['Summary of Business'])[:500].replace("\n", " ")
+        parts.append(f"Code: {item['Code']}\nSummary: {summary_snippet}...\n---\n")
+    # 文字列の += を繰り返さず、最後に一度だけ連結する
+    input_text = "".join(parts)
+
+    prompt = f"""
+    You are a financial analyst. I will provide business summaries for multiple companies.
+    Extract the main 'Business Segments' for EACH company based on the summary.
+
+    # Input Data
+    {input_text}
+    
+    # Output Rules
+    - Return ONLY a valid JSON object.
+    - The keys must be the stock 'Code'.
+    - The values must be the 'Business Segments' (comma separated string, clear and concise).
+    - If segments are not clearly stated, summarize the main business areas in 3-4 words.
+    - Example JSON Format:
+    {{
+        "4863.KL": "Telecommunication Services, Digital Solutions",
+        "0021.KL": "Payment Services, Solution Services"
+    }}
+    """
+
+    print(f"  - バッチ処理中: {i+1}〜{current_count} 件目...")
+    try:
+        # 1分あたりの上限を守り、レート制限 (429) の時は待って再試行する
+        response = stock_common.generate_content(client, model_name, prompt)
+        response_text = response.text.strip()
+        
+        if "```json" in response_text:
+            response_text = response_text.split("```json")[1].split("```")[0].strip()
+        elif "```" in response_text:
+            response_text = response_text.split("```")[1].split("```")[0].strip()
+        
+        segments_map = orjson.loads(response_text)
+
+        for item in batch:
+            code = item['Code']
+            if code in segments_map:
+                item['Segments'] = segments_map[code]
+
+    except orjson.JSONDecodeError as e:
+        print(f"  ⚠️ AIの応答をJSONとして解析できませんでした (このバッチはスキップします): {e}")
+    except Exception as e:
+        print(f"  ⚠️ バッチ処理エラー (このバッチはスキップします): {e}")
 
 
 # --- 2. データ取得関数 ---
+# app.py と data_processor.py は同じ銘柄でも保存する形が異なるため、ディレクトリを分ける
+CACHE_DIR = os.path.join(stock_common.CACHE_ROOT, "data_processor")
+
+
 def get_stock_data(code):
+    """
+    銘柄データを取得します。同日中に取得済みの銘柄はディスクキャッシュから返します。
+    """
+    return stock_common.get_stock_data(code, _request_stock_data, CACHE_DIR)
+
+
+def _request_stock_data(code):
     try:
         ticker = yf.Ticker(code)
         try:
-            info = ticker.info
-        except:
+            info = dict(ticker.info or {})
+        except YFRateLimitError:
+            raise
+        except Exception:
             return None
             
         if not info:
@@ -107,15 +147,28 @@ def get_stock_data(code):
             "institutional_holders": ticker.institutional_holders
         }
         return raw_data
+    except YFRateLimitError:
+        raise
     except Exception as e:
         print(f"  データ取得エラー: {e}")
         return None
 
+
+def get_all_stock_data(codes, max_workers=8, progress_callback=None):
+    """
+    複数銘柄のデータをスレッドで並列取得します。
+    戻り値は {コード: raw_data (取得失敗時は None)} の辞書です。
+    progress_callback(完了数, 総数) は進捗に応じて間引いて呼ばれます (最後の1件では必ず呼ばれます)。
+    """
+    return stock_common.get_all_stock_data(codes, get_stock_data, max_workers, progress_callback)
+
+
 # ★変更: 為替レートも「前日終値」を優先取得
 def get_exchange_rate(from_currency):
     """
     指定された通貨からSGDへの為替レート (SGD/外貨) を取得します。
     整合性を保つため、株価と同様に 'previousClose' を優先します。
+    同じ通貨は1日1回だけ取得し、以降はキャッシュを返します。
     """
     if not from_currency or from_currency == "SGD":
         return 1.0
@@ -125,27 +178,43 @@ def get_exchange_rate(from_currency):
     else:
         currency_code = from_currency
 
-    pair = f"{currency_code}SGD=X"
-    
     try:
-        ticker = yf.Ticker(pair)
-        
-        # 1. まず info から previousClose (前日終値) を取得
-        rate = ticker.info.get('previousClose')
-        
-        # 2. 取れなければ履歴データの最新終値で代用
-        if rate is None:
-            hist = ticker.history(period="5d")
-            if not hist.empty:
-                rate = hist['Close'].iloc[-1]
-            else:
-                return "N/A"
-        
-        return rate
-    except:
+        return _fetch_exchange_rate(currency_code, date.today())
+    except Exception:
         return "N/A"
 
 
+# 通信エラーやデータなしの時は例外になりキャッシュされないため、次回呼び出しで再取得される
+@lru_cache(maxsize=32)
+def _fetch_exchange_rate(currency_code, cache_day):
+    pair = f"{currency_code}SGD=X"
+    ticker = yf.Ticker(pair)
+    
+    # 1. まず info から previousClose (前日終値) を取得
+    rate = ticker.info.get('previousClose')
+    
+    # 2. 取れなければ履歴データの最新終値で代用
+    if rate is None:
+        hist = ticker.history(period="5d")
+        if not hist.empty:
+            rate = hist['Close'].iloc[-1]
+        else:
+            # "N/A" を返すとその日はキャッシュされてしまうため、例外にして再取得させる
+            raise ValueError(f"為替レートを取得できません: {pair}")
+    
+    return rate
+
+
+def prefetch_exchange_rates(raw_data_list, max_workers=8):
+    """
+    取得済みデータに含まれる通貨の為替レートを並列でまとめて取得し、
+    {通貨: レート} の辞書で返します。extract_data の exchange_rates に渡してください。
+    """
+    currencies = list({get_display_currency(raw["info"]) for raw in raw_data_list if raw})
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(currencies, executor.map(get_exchange_rate, currencies)))
+
+
 # --- 3. データの整形・抽出 ---
 def format_shareholders(holders_data, data_type="institutional"):
     if holders_data is None or holders_data.empty:
@@ -172,7 +241,7 @@ def format_shareholders(holders_data, data_type="institutional"):
                         if val_float < 1.0: 
                             val_float = val_float * 100
                         line = f"{name}: {val_float:.2f}%"
-                    except:
+                    except (TypeError, ValueError):
                         line = f"{name}: {val}"
                     result_lines.append(line)
 
@@ -190,7 +259,7 @@ def format_shareholders(holders_data, data_type="institutional"):
                                  line = f"{desc}: {val_float:.2%}"
                              else:
                                  line = f"{desc}: {val}"
-                    except:
+                    except (TypeError, ValueError):
                         line = f"{desc}: {val}"
                     result_lines.append(line)
 
@@ -215,7 +284,42 @@ def format_shareholders(holders_data, data_type="institutional"):
     return "\n".join(result_lines)
 
 
-def extract_data(code, raw_data):
+INCOME_KEYS = [
+    "Total Revenue", "Pretax Income", "Operating Income", "Gross Profit",
+    "Net Income", "Net Income Common Stock",
+    "Net Income Including Noncontrolling Interests", "Net Income Continuous Operations"
+]
+BALANCE_KEYS = [
+    "Minority Interest", "Stockholders Equity", "Total Assets",
+    "Total Equity Gross Minority Interest", "Current Debt", "Long Term Debt",
+    "Total Debt", "Capital Lease Obligations"
+]
+
+
+def latest_values(df, latest_date, keys):
+    """
+    財務諸表の最新期カラムから、指定した科目をまとめて {科目: 値} で返します。
+    存在しない科目は 0 になります。
+    """
+    if df is None or df.empty or latest_date is None or latest_date not in df.columns:
+        return dict.fromkeys(keys, 0)
+    col = df[latest_date]
+    col = col[~col.index.duplicated()]
+    return col.reindex(keys, fill_value=0).to_dict()
+
+
+def get_display_currency(info):
+    raw_currency = info.get('financialCurrency')
+    if not raw_currency:
+        raw_currency = info.get('currency', 'SGD') 
+        
+    display_currency = raw_currency
+    if display_currency == 'CNY':
+        display_currency = 'RMB (CNY)'
+    return display_currency
+
+
+def extract_data(code, raw_data, exchange_rates=None):
     info = raw_data.get("info", {})
     bs = raw_data.get("balance_sheet")
     inc = raw_data.get("financials")
@@ -238,42 +342,38 @@ def extract_data(code, raw_data):
     elif inc is not None and not inc.empty:
         latest_date = inc.columns[0]
 
-    def get_fin_value(df, key):
-        if (df is not None and not df.empty and 
-            key in df.index and 
-            latest_date is not None and 
-            latest_date in df.columns):
-            return df.loc[key, latest_date]
-        return 0
-
-    revenue = get_fin_value(inc, "Total Revenue")
-    pretax_income = get_fin_value(inc, "Pretax Income")
-    operating_income = get_fin_value(inc, "Operating Income")
-    gross_profit = get_fin_value(inc, "Gross Profit")
+    # 必要な科目を最新期のカラムからまとめて取り出す (1科目ずつ .loc で引かない)
+    inc_vals = latest_values(inc, latest_date, INCOME_KEYS)
+    bs_vals = latest_values(bs, latest_date, BALANCE_KEYS)
+
+    revenue = inc_vals["Total Revenue"]
+    pretax_income = inc_vals["Pretax Income"]
+    operating_income = inc_vals["Operating Income"]
+    gross_profit = inc_vals["Gross Profit"]
     profit = pretax_income if pretax_income != 0 else operating_income
 
-    net_profit_owners = get_fin_value(inc, "Net Income")
+    net_profit_owners = inc_vals["Net Income"]
     if net_profit_owners == 0:
-        net_profit_owners = get_fin_value(inc, "Net Income Common Stock")
+        net_profit_owners = inc_vals["Net Income Common Stock"]
 
-    net_profit_group = get_fin_value(inc, "Net Income Including Noncontrolling Interests")
+    net_profit_group = inc_vals["Net Income Including Noncontrolling Interests"]
     if net_profit_group == 0:
-         net_profit_group = get_fin_value(inc, "Net Income Continuous Operations")
+         net_profit_group = inc_vals["Net Income Continuous Operations"]
     
-    minority_interest = get_fin_value(bs, "Minority Interest")
+    minority_interest = bs_vals["Minority Interest"]
     if net_profit_group == 0 and net_profit_owners != 0:
         net_profit_group = net_profit_owners
 
-    stockholders_equity = get_fin_value(bs, "Stockholders Equity")
-    total_assets = get_fin_value(bs, "Total Assets")
-    total_equity = get_fin_value(bs, "Total Equity Gross Minority Interest")
+    stockholders_equity = bs_vals["Stockholders Equity"]
+    total_assets = bs_vals["Total Assets"]
+    total_equity = bs_vals["Total Equity Gross Minority Interest"]
     if total_equity == 0 and stockholders_equity != 0:
         total_equity = stockholders_equity + minority_interest
 
-    current_loan = get_fin_value(bs, "Current Debt")
-    non_current_loan = get_fin_value(bs, "Long Term Debt")
-    loan = get_fin_value(bs, "Total Debt")
-    capital_lease = get_fin_value(bs, "Capital Lease Obligations")
+    current_loan = bs_vals["Current Debt"]
+    non_current_loan = bs_vals["Long Term Debt"]
+    loan = bs_vals["Total Debt"]
+    capital_lease = bs_vals["Capital Lease Obligations"]
     if loan != 0 and capital_lease != 0:
         if loan > capital_lease:
             loan = loan - capital_lease
@@ -293,7 +393,7 @@ def extract_data(code, raw_data):
     if info.get('lastFiscalYearEnd'):
         try:
             fy_date = datetime.fromtimestamp(info['lastFiscalYearEnd'])
-        except:
+        except (TypeError, ValueError, OSError, OverflowError):
             pass
 
     officers = info.get('companyOfficers', [])
@@ -317,16 +417,13 @@ def extract_data(code, raw_data):
     industry = info.get('industry')
     
     # 通貨情報の取得と整形
-    raw_currency = info.get('financialCurrency')
-    if not raw_currency:
-        raw_currency = info.get('currency', 'SGD') 
-        
-    display_currency = raw_currency
-    if display_currency == 'CNY':
-        display_currency = 'RMB (CNY)'
+    display_currency = get_display_currency(info)
     
-    # 為替レートの取得 (前日終値)
-    exchange_rate = get_exchange_rate(display_currency)
+    # 為替レートの取得 (前日終値)。先読み済みのレートがあればそれを使う
+    if exchange_rates and display_currency in exchange_rates:
+        exchange_rate = exchange_rates[display_currency]
+    else:
+        exchange_rate = get_exchange_rate(display_currency)
 
     website = info.get('website', '')
     
@@ -358,8 +455,7 @@ def extract_data(code, raw_data):
         # 計算不能ならYahooの値をそのまま使う
         market_cap = info.get('marketCap')
 
-    stock_price_col_name = "Stock Price"
-
+    # キーは RESULT_COLUMNS と同じ固定の列名のみを使う (別名を作らない)
     result = {
         "Name of Company": info.get('longName'),
         "Code": code,
@@ -383,7 +479,7 @@ def extract_data(code, raw_data):
         "Loan": loan,
         "Loan/Equity (%)": loan_equity_ratio,
         
-        stock_price_col_name: current_price,
+        "Stock Price": current_price,
         "Shares Outstanding": shares_outstanding,
         "Market Cap": market_cap,
         
@@ -401,38 +497,27 @@ def extract_data(code, raw_data):
 # --- 4. Excel出力用整形 ---
 def format_for_excel(df):
     print("データを千単位('000)に変換しています...")
-    money_cols = [
-        'REVENUE', 'PROFIT', 'GROSS PROFIT', 'OPERATING PROFIT', 
-        'NET PROFIT (Group)', 'NET PROFIT (Shareholders)',
-        'Minority Interest',
-        "Shareholders' Equity", 'Total Equity', 'TOTAL ASSET',
-        'Loan',
-        'Market Cap',
-        'Shares Outstanding'
-    ]
-    
     divisor = 1000.0
 
-    for col in money_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-            df[col] = df[col] / divisor
+    # 列ごとにループせず、金額列をまとめて数値化して一括で割り算する
+    money_cols = [c for c in MONEY_COLS if c in df.columns]
+    if money_cols:
+        df[money_cols] = df[money_cols].apply(pd.to_numeric, errors='coerce') / divisor
 
     pct_cols = ["Debt/Equity(%)", "Loan/Equity (%)"]
     for col in pct_cols:
          if col in df.columns:
             df[col] = pd.to_numeric(df[col], errors='coerce')
 
-    rename_map = {c: f"{c} ('000)" for c in money_cols}
-    df = df.rename(columns=rename_map)
-    
-    if "REVENUE ('000)" in df.columns:
-        df = df.rename(columns={"REVENUE ('000)": "REVENUE SGD('000)"})
+    df = df.rename(columns=MONEY_RENAME_MAP)
 
     print("日付を 'Month YYYY' 形式に変換しています...")
     date_cols = ['FY']
     for col in date_cols:
         if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors='coerce').dt.strftime('%b %Y').fillna('')
+            # extract_data で既に datetime になっている場合は再パースしない
+            if not pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+            df[col] = df[col].dt.strftime('%b %Y').fillna('')
 
     return df
\ No newline at end of file
@@ -0,0 +1,269 @@
+import pandas as pd
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+try:
+    from yfinance.exceptions import YFRateLimitError
+except ImportError:
+    # 古い yfinance にはレート制限専用の例外がないため、何にも一致しない例外で代用する
+    class YFRateLimitError(Exception):
+        pass
+
+# app.py と data_processor.py で共通の処理。
+# レート制限はプロセス全体で1つにする必要があるため、両方のモジュールがここを使う
+
+
+# --- 0. 銘柄リストの読み込み ---
+def read_codes(source):
+    """
+    1列の銘柄リスト (CSV) からコードの一覧を読み込みます。
+    source にはファイルパスまたはファイルオブジェクトを渡せます。
+    """
+    # pandas の DataFrame は作らず、1列目だけを順に読み出す
+    if hasattr(source, "read"):
+        if isinstance(source, io.TextIOBase):
+            return _codes_from_rows(csv.reader(source))
+        # Streamlit の UploadedFile などバイナリのファイルはテキストとして包んで読む
+        text = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+        try:
+            return _codes_from_rows(csv.reader(text))
+        finally:
+            # 包んだラッパーが元のファイルを閉じないように切り離す
+            text.detach()
+    with open(source, newline="", encoding="utf-8-sig") as f:
+        return _codes_from_rows(csv.reader(f))
+
+
+def _codes_from_rows(rows):
+    # 呼び出し側が開いたテキストファイルでは BOM が残るため、ここで必ず取り除く
+    codes = (row[0].strip().lstrip("\ufeff") for row in rows if row)
+    return [code for code in codes if code]
+
+
+# --- 1. レート制限 ---
+class TokenBucket:
+    """
+    トークンバケット方式のレート制限。平均 rate 回/秒のペースを保ちつつ、
+    溜まっているトークンの分だけは待たずに連続で通します。
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # トークンが足りない場合はマイナスにして、後続のスレッドの順番を予約する
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Yahoo Finance へのリクエスト間隔の制御 (並列取得時もこのペースを超えない)
+REQUESTS_PER_SECOND = 4
+_BUCKET = TokenBucket(rate=REQUESTS_PER_SECOND)
+
+# レート制限 (HTTP 429) を受けた時だけ待って再試行する。成功時は一切待たない
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 2.0
+
+# Gemini の1分あたりのリクエスト上限 (無料枠の RPM に合わせる)。
+# 同時実行数を絞っても1分あたりの回数は減らないため、こちらで回数そのものを制限する
+AI_REQUESTS_PER_MINUTE = 10
+_AI_BUCKET = TokenBucket(rate=AI_REQUESTS_PER_MINUTE / 60)
+
+# google-genai は 429 を自動で再試行しないため、自前で待って再試行する
+AI_MAX_RETRIES = 3
+AI_BACKOFF_SECONDS = 10.0
+
+
+def generate_content(client, model_name, prompt):
+    """
+    Gemini にリクエストします。AI_REQUESTS_PER_MINUTE を超えないよう待ち、
+    レート制限 (429) を受けた時だけ間隔を空けて再試行します。
+    """
+    # client がある時点で google-genai は読み込み済みなので、ここでの import は軽い
+    from google.genai import errors as genai_errors
+
+    for attempt in range(AI_MAX_RETRIES + 1):
+        _AI_BUCKET.acquire()
+        try:
+            return client.models.generate_content(model=model_name, contents=prompt)
+        except genai_errors.APIError as e:
+            if e.code != 429 or attempt == AI_MAX_RETRIES:
+                raise
+            time.sleep(AI_BACKOFF_SECONDS * 2 ** attempt)
+
+
+# --- 2. ディスクキャッシュ ---
+CACHE_ROOT = ".yf_cache"
+
+_prune_lock = threading.Lock()
+_pruned_days = {}
+
+
+def _cache_path(cache_dir, code, day):
+    # 日付をキーに含めることで、取得データは1日ごとに自動で更新される
+    # 銘柄コードはアップロードされた入力なので、そのままパスに使わずハッシュ化する
+    key = hashlib.sha256(code.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(cache_dir, f"{key}_{day}.pkl")
+
+
+def _load_cache(cache_path):
+    try:
+        with open(cache_path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # 壊れたファイルや互換性のない pickle は削除し、取り直させる
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+        return None
+
+
+def _save_cache(cache_dir, cache_path, raw_data, day):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        _prune_cache(cache_dir, day)
+        # 同じ銘柄を複数スレッドが書いても読み手が書きかけを見ないよう、一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=f"{day}_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(raw_data, f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except Exception:
+        pass
+
+
+def _prune_cache(cache_dir, day):
+    # 他の日付のキャッシュは1日1回まとめて削除し、ファイルが増え続けないようにする
+    with _prune_lock:
+        if _pruned_days.get(cache_dir) == day:
+            return
+        _pruned_days[cache_dir] = day
+    for name in os.listdir(cache_dir):
+        if day not in name:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
+# --- 3. データ取得 ---
+def get_stock_data(code, request, cache_dir):
+    """
+    request(code) で銘柄データを取得します。同日中に取得済みの銘柄は
+    cache_dir のディスクキャッシュから返します。
+    request はデータの形がモジュールごとに異なるため、呼び出し側が渡します。
+    """
+    day = date.today().isoformat()
+    cache_path = _cache_path(cache_dir, code, day)
+    raw_data = _load_cache(cache_path)
+    if raw_data is not None:
+        return raw_data
+
+    raw_data = _fetch_stock_data(code, request)
+    if raw_data is not None:
+        _save_cache(cache_dir, cache_path, raw_data, day)
+    return raw_data
+
+
+def _fetch_stock_data(code, request):
+    for attempt in range(MAX_RETRIES + 1):
+        _BUCKET.acquire()
+        try:
+            return request(code)
+        except YFRateLimitError:
+            if attempt == MAX_RETRIES:
+                print(f"  データ取得エラー ({code}): レート制限のためスキップします")
+                return None
+            time.sleep(BACKOFF_SECONDS * 2 ** attempt)
+
+
+def get_all_stock_data(codes, get_one, max_workers=8, progress_callback=None):
+    """
+    複数銘柄のデータを get_one(code) を使ってスレッドで並列取得します。
+    戻り値は {コード: raw_data (取得失敗時は None)} の辞書です。
+    progress_callback(完了数, 総数) は進捗に応じて間引いて呼ばれます (最後の1件では必ず呼ばれます)。
+    """
+    # 同じ銘柄が複数回指定されても取得は1回にする
+    codes = list(dict.fromkeys(str(c).strip() for c in codes))
+    total = len(codes)
+    results = {}
+
+    last_update = time.monotonic()
+
+    # 通信待ちが支配的なので、スレッドでリクエストを重ねて待ち時間を短縮する
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(get_one, code): code for code in codes}
+        for done, future in enumerate(as_completed(futures), start=1):
+            code = futures[future]
+            try:
+                results[code] = future.result()
+            except Exception as e:
+                print(f"  データ取得エラー ({code}): {e}")
+                results[code] = None
+            # UI への通知は間引く: 前回から0.25秒以上経過した時だけ (最後は必ず通知)
+            if progress_callback and (
+                done == total or time.monotonic() - last_update >= 0.25
+            ):
+                progress_callback(done, total)
+                last_update = time.monotonic()
+
+    return results
+
+
+# --- 4. 結果の列定義 ---
+MONEY_COLS = [
+    'REVENUE', 'PROFIT', 'GROSS PROFIT', 'OPERATING PROFIT',
+    'NET PROFIT (Group)', 'NET PROFIT (Shareholders)',
+    'Minority Interest',
+    "Shareholders' Equity", 'Total Equity', 'TOTAL ASSET',
+    'Loan',
+    'Market Cap',
+    'Shares Outstanding'
+]
+# 売上高だけは SGD 建てと明記した列名にする (列名の変更は1回の rename で済ませる)
+MONEY_RENAME_MAP = {c: f"{c} ('000)" for c in MONEY_COLS}
+MONEY_RENAME_MAP['REVENUE'] = "REVENUE SGD('000)"
+RESULT_COLUMNS = [
+    "Name of Company", "Code", "Currency", "Exchange Rate", "Website",
+    "Major Shareholders", "FY", "REVENUE", "Segments", "PROFIT", "GROSS PROFIT",
+    "OPERATING PROFIT", "NET PROFIT (Group)", "NET PROFIT (Shareholders)",
+    "Minority Interest", "Shareholders' Equity", "Total Equity", "TOTAL ASSET",
+    "Debt/Equity(%)", "Loan", "Loan/Equity (%)", "Stock Price",
+    "Shares Outstanding", "Market Cap", "Summary of Business", "Chairman / CEO",
+    "Address", "Contact No.", "Number of Employee",
+    "Category Classification/YahooFin", "Sector & Industry/YahooFin", "Market"
+]
+NUMERIC_DTYPES = {
+    c: 'float64' for c in MONEY_COLS + ["Debt/Equity(%)", "Loan/Equity (%)", "Stock Price"]
+}
+
+
+def results_to_dataframe(all_results):
+    """
+    extract_data の結果 (dict のリスト) を DataFrame に変換します。
+    列順を固定して生成し、数値列は型推論させずに float64 へ一括で変換します。
+    """
+    df = pd.DataFrame.from_records(all_results, columns=RESULT_COLUMNS)
+    return df.astype(NUMERIC_DTYPES)